@@ -0,0 +1 @@
+twisted.python.lockfile no longer uses pywin32 on Windows; it checks whether the owner of a lock is still running with ctypes, and treats an owner which has exited as gone even if handles to it are still open.
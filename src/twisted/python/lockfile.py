@@ -12,22 +12,91 @@ from __future__ import absolute_import, division
 import errno
 import os
 
-from time import time as _uniquefloat
+from itertools import count
+from time import sleep as _sleep
 
 from twisted.python.runtime import platform
-from twisted.python.compat import _PY3
+
+# Looked up on every failed attempt to take a lock.
+_EEXIST = errno.EEXIST
+_ENOENT = errno.ENOENT
+_EACCES = errno.EACCES
+_EIO = errno.EIO
+_ESRCH = errno.ESRCH
+_EPERM = errno.EPERM
+
+# Returned instead of raising by the Windows implementations of symlink and
+# readlink when a lock is in the middle of being deleted.
+_Retry = object()
+
+
+
+if getattr(os, "register_at_fork", None) is not None:
+    _pidString = None
+
+    def _getPIDString():
+        """
+        Get the PID of this process as a string, suitable for use as the
+        contents of a lock.
+
+        The string is computed once and reused until the process forks.
+        """
+        global _pidString
+        if _pidString is None:
+            _pidString = str(os.getpid())
+        return _pidString
+
+
+    def _resetPIDString():
+        """
+        Forget the PID cached by L{_getPIDString}, since it belongs to our
+        parent process.
+        """
+        global _pidString
+        _pidString = None
+
+
+    os.register_at_fork(after_in_child=_resetPIDString)
+else:
+    def _getPIDString():
+        """
+        Get the PID of this process as a string, suitable for use as the
+        contents of a lock.
+        """
+        return str(os.getpid())
+
+
+
+_uniqueCounter = count()
 
 def unique():
-    return str(int(_uniquefloat() * 1000))
+    """
+    Get a string which is unique among all calls to this function by any
+    process on this host, suitable for naming temporary files.
+    """
+    return "%s.%d" % (_getPIDString(), next(_uniqueCounter))
+
+
 
 from os import rename
 
 if not platform.isWindows():
     from os import kill
     from os import symlink
-    from os import readlink
     from os import remove as rmlink
     _windows = False
+
+    def readlink(filename):
+        """
+        Read the target of the symlink at C{filename}.
+
+        The target is returned as a native string even if C{filename} is
+        L{bytes}, so that it can be compared with L{_getPIDString}.
+        """
+        value = os.readlink(filename)
+        if isinstance(value, bytes):
+            value = value.decode("ascii")
+        return value
 else:
     _windows = True
 
@@ -41,75 +110,122 @@ else:
     # These functions below perform that unenviable, probably-fraught-with-
     # race-conditions duty. - hawkie
 
-    try:
-        from win32api import OpenProcess
-        import pywintypes
-    except ImportError:
-        kill = None
-    else:
-        ERROR_ACCESS_DENIED = 5
-        ERROR_INVALID_PARAMETER = 87
-
-        def kill(pid, signal):
-            try:
-                OpenProcess(0, 0, pid)
-            except pywintypes.error as e:
-                if e.args[0] == ERROR_ACCESS_DENIED:
-                    return
-                elif e.args[0] == ERROR_INVALID_PARAMETER:
-                    raise OSError(errno.ESRCH, None)
-                raise
-            else:
-                raise RuntimeError("OpenProcess is required to fail.")
+    ERROR_ACCESS_DENIED = 5
+    ERROR_INVALID_PARAMETER = 87
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    STILL_ACTIVE = 259
 
-    # For monkeypatching in tests
-    _open = open
+    def _killWin32(pid, signal):
+        """
+        Check that the process C{pid} is running, like C{kill(pid, 0)}.
+
+        Only the right to query limited information about the process is
+        requested, which is granted for processes of other users too.  A
+        process which has exited is reported as missing even if handles to it
+        are still open.
+
+        @raise OSError: With C{errno} set to C{ESRCH} if the process doesn't
+            exist or has exited.
+        """
+        handle = _kernel32.OpenProcess(
+            PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            error = ctypes.get_last_error()
+            if error == ERROR_ACCESS_DENIED:
+                return
+            elif error == ERROR_INVALID_PARAMETER:
+                raise OSError(_ESRCH, None)
+            raise ctypes.WinError(error)
+        try:
+            code = wintypes.DWORD()
+            if not _kernel32.GetExitCodeProcess(handle, ctypes.byref(code)):
+                raise ctypes.WinError(ctypes.get_last_error())
+        finally:
+            _kernel32.CloseHandle(handle)
+        if code.value != STILL_ACTIVE:
+            raise OSError(_ESRCH, None)
 
 
+    def kill(pid, signal):
+        """
+        Load the Windows API functions used to check on processes the first
+        time one needs to be checked, and replace this function with
+        L{_killWin32}.
+
+        If ctypes is not available, C{kill} is set to L{None} instead and the
+        process is assumed to exist.
+        """
+        global kill, ctypes, wintypes, _kernel32
+        try:
+            import ctypes
+            from ctypes import wintypes
+        except ImportError:
+            kill = None
+            return
+        _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        _kernel32.OpenProcess.argtypes = (
+            wintypes.DWORD, wintypes.BOOL, wintypes.DWORD)
+        _kernel32.OpenProcess.restype = wintypes.HANDLE
+        _kernel32.GetExitCodeProcess.argtypes = (
+            wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD))
+        _kernel32.GetExitCodeProcess.restype = wintypes.BOOL
+        _kernel32.CloseHandle.argtypes = (wintypes.HANDLE,)
+        _kernel32.CloseHandle.restype = wintypes.BOOL
+        kill = _killWin32
+        return kill(pid, signal)
+
     def symlink(value, filename):
         """
         Write a file at C{filename} with the contents of C{value}. See the
         above comment block as to why this is needed.
+
+        @return: L{_Retry} if the lock at C{filename} is in the middle of
+            being deleted, L{None} otherwise.
         """
         # XXX Implement an atomic thingamajig for win32
         newlinkname = filename + "." + unique() + '.newlink'
         newvalname = os.path.join(newlinkname, "symlink")
         os.mkdir(newlinkname)
 
-        # Python 3 does not support the 'commit' flag of fopen in the MSVCRT
-        # (http://msdn.microsoft.com/en-us/library/yeby3zcb%28VS.71%29.aspx)
-        if _PY3:
-            mode = 'w'
-        else:
-            mode = 'wc'
-
-        with _open(newvalname, mode) as f:
-            f.write(value)
-            f.flush()
+        fd = os.open(newvalname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        try:
+            os.write(fd, value.encode("ascii"))
+        finally:
+            os.close(fd)
 
         try:
-            rename(newlinkname, filename)
-        except:
-            os.remove(newvalname)
-            os.rmdir(newlinkname)
+            try:
+                rename(newlinkname, filename)
+            except:
+                os.remove(newvalname)
+                os.rmdir(newlinkname)
+                raise
+        except (IOError, OSError) as e:
+            if e.errno == _EACCES or e.errno == _EIO:
+                # Renaming fails like this while the old lock is being
+                # deleted, since removing a directory isn't atomic.
+                return _Retry
             raise
 
 
     def readlink(filename):
         """
-        Read the contents of C{filename}. See the above comment block as to why
-        this is needed.
+        Read the contents of C{filename}. See the above comment block as to
+        why this is needed.
+
+        @return: The contents of C{filename}, or L{_Retry} if the lock is in
+            the middle of being deleted.
         """
         try:
-            fObj = _open(os.path.join(filename, 'symlink'), 'r')
-        except IOError as e:
-            if e.errno == errno.ENOENT or e.errno == errno.EIO:
-                raise OSError(e.errno, None)
+            fd = os.open(os.path.join(filename, 'symlink'), os.O_RDONLY)
+        except OSError as e:
+            if e.errno == _EACCES:
+                return _Retry
             raise
-        else:
-            with fObj:
-                result = fObj.read()
-            return result
+        try:
+            return os.read(fd, 32).decode("ascii")
+        finally:
+            os.close(fd)
 
 
     def rmlink(filename):
@@ -118,6 +234,74 @@ else:
 
 
 
+def _alive(pid):
+    """
+    Determine whether the process which wrote C{pid} to a lock still exists by
+    sending it signal C{0}.
+
+    A process which we aren't allowed to signal, because it belongs to
+    another user, exists.
+
+    @param pid: The contents of a lock.
+    @type pid: L{str}
+
+    @return: C{False} if the process does not exist, C{True} if it does or if
+        there is no way to tell.
+
+    @raise: Any exception L{kill} may raise, other than C{ESRCH} and
+        C{EPERM}.
+    """
+    if kill is None:
+        return True
+    try:
+        kill(int(pid), 0)
+    except OSError as e:
+        if e.errno == _ESRCH:
+            return False
+        if e.errno != _EPERM:
+            raise
+    return True
+
+
+
+class _Backoff(object):
+    """
+    Truncated exponential backoff for the retry loop of L{FilesystemLock.lock}.
+
+    Each call to L{snooze} sleeps twice as long as the previous one, starting
+    at C{initial} seconds and levelling off at C{maximum} seconds.
+
+    @ivar step: The number of times the delay has been doubled since this
+        object was created or last L{reset}.
+    """
+
+    initial = 1e-6
+    maximum = 0.01
+
+    def __init__(self):
+        self.step = 0
+
+
+    def snooze(self):
+        """
+        Sleep for the current delay and double it for the next call.
+        """
+        delay = self.initial * (1 << self.step)
+        if delay < self.maximum:
+            self.step += 1
+        else:
+            delay = self.maximum
+        _sleep(delay)
+
+
+    def reset(self):
+        """
+        Go back to the initial delay.
+        """
+        self.step = 0
+
+
+
 class FilesystemLock(object):
     """
     A mutex.
@@ -137,11 +321,12 @@ class FilesystemLock(object):
         object.
     """
 
-    clean = None
-    locked = False
+    __slots__ = ('name', 'clean', 'locked')
 
     def __init__(self, name):
         self.name = name
+        self.clean = None
+        self.locked = False
 
 
     def lock(self):
@@ -152,54 +337,60 @@ class FilesystemLock(object):
         @return: True if the lock is acquired, false otherwise.
 
         @raise: Any exception os.symlink() may raise, other than
-        EEXIST.
+        EEXIST, any exception L{kill} may raise, other than ESRCH, or
+        any exception rmlink() may raise, other than ENOENT.
         """
         clean = True
+        backoff = None
+        pidString = _getPIDString()
         while True:
             try:
-                symlink(str(os.getpid()), self.name)
-            except OSError as e:
-                if _windows and e.errno in (errno.EACCES, errno.EIO):
-                    # The lock is in the middle of being deleted because we're
-                    # on Windows where lock removal isn't atomic.  Give up, we
+                if symlink(pidString, self.name) is _Retry:
+                    # The lock is in the middle of being deleted because
+                    # lock removal isn't atomic on Windows.  Give up, we
                     # don't know how long this is going to take.
                     return False
-                if e.errno == errno.EEXIST:
+            except OSError as e:
+                if e.errno == _EEXIST:
                     try:
                         pid = readlink(self.name)
                     except (IOError, OSError) as e:
-                        if e.errno == errno.ENOENT:
+                        if e.errno == _ENOENT:
                             # The lock has vanished, try to claim it in the
                             # next iteration through the loop.
+                            if backoff is None:
+                                backoff = _Backoff()
+                            backoff.snooze()
                             continue
-                        elif _windows and e.errno == errno.EACCES:
-                            # The lock is in the middle of being
-                            # deleted because we're on Windows where
-                            # lock removal isn't atomic.  Give up, we
-                            # don't know how long this is going to
-                            # take.
-                            return False
                         raise
+                    if pid is _Retry:
+                        # The lock is in the middle of being deleted
+                        # because lock removal isn't atomic on Windows.
+                        # Give up, we don't know how long this is going
+                        # to take.
+                        return False
+                    if _alive(pid):
+                        return False
+                    # The owner has vanished, try to claim it in the next
+                    # iteration through the loop.
                     try:
-                        if kill is not None:
-                            kill(int(pid), 0)
+                        rmlink(self.name)
                     except OSError as e:
-                        if e.errno == errno.ESRCH:
-                            # The owner has vanished, try to claim it in the
-                            # next iteration through the loop.
-                            try:
-                                rmlink(self.name)
-                            except OSError as e:
-                                if e.errno == errno.ENOENT:
-                                    # Another process cleaned up the lock.
-                                    # Race them to acquire it in the next
-                                    # iteration through the loop.
-                                    continue
-                                raise
-                            clean = False
+                        if e.errno == _ENOENT:
+                            # Another process cleaned up the lock.  Race
+                            # them to acquire it in the next iteration
+                            # through the loop.
+                            if backoff is None:
+                                backoff = _Backoff()
+                            backoff.snooze()
                             continue
                         raise
-                    return False
+                    clean = False
+                    # We removed the stale lock ourselves, so there is no
+                    # reason to wait before trying again.
+                    if backoff is not None:
+                        backoff.reset()
+                    continue
                 raise
             self.locked = True
             self.clean = clean
@@ -210,13 +401,13 @@ class FilesystemLock(object):
         """
         Release this lock.
 
-        This deletes the directory with the given name.
+        This deletes the lock with the given name.
 
         @raise: Any exception os.readlink() may raise, or
         ValueError if the lock is not owned by this process.
         """
         pid = readlink(self.name)
-        if int(pid) != os.getpid():
+        if pid != _getPIDString():
             raise ValueError(
                 "Lock %r not owned by this process" % (self.name,))
         rmlink(self.name)
@@ -234,14 +425,17 @@ def isLocked(name):
     @rtype: C{bool}
     @return: True if the lock is held, False otherwise.
     """
-    l = FilesystemLock(name)
-    result = None
     try:
-        result = l.lock()
-    finally:
-        if result:
-            l.unlock()
-    return not result
+        pid = readlink(name)
+    except (IOError, OSError) as e:
+        if e.errno == _ENOENT:
+            return False
+        raise
+    if pid is _Retry:
+        # The lock is in the middle of being deleted because we're on Windows
+        # where lock removal isn't atomic.  Until it's gone, it's still held.
+        return True
+    return _alive(pid)
 
 
 
@@ -17,12 +17,9 @@ from twisted.python.reflect import requireModule
 from twisted.python.runtime import platform
 
 skipKill = None
-if platform.isWindows():
-    if(requireModule('win32api.OpenProcess') is None and
-        requireModule('pywintypes') is None
-            ):
-        skipKill = ("On windows, lockfile.kill is not implemented in the "
-                    "absence of win32api and/or pywintypes.")
+if platform.isWindows() and requireModule('ctypes') is None:
+    skipKill = ("On windows, lockfile.kill is not implemented in the "
+                "absence of ctypes.")
 
 class UtilTests(unittest.TestCase):
     """
@@ -41,21 +38,35 @@ class UtilTests(unittest.TestCase):
 
     def test_symlinkEIOWindows(self):
         """
-        L{lockfile.symlink} raises L{OSError} with C{errno} set to L{EIO} when
-        the underlying L{rename} call fails with L{EIO}.
+        L{lockfile.symlink} returns L{lockfile._Retry} when the underlying
+        L{rename} call fails with L{EIO} or L{EACCES}.
 
         Renaming a file on Windows may fail if the target of the rename is in
         the process of being deleted (directory deletion appears not to be
         atomic).
         """
+        for error in (errno.EIO, errno.EACCES):
+            name = self.mktemp()
+            def fakeRename(src, dst):
+                raise IOError(error, None)
+            self.patch(lockfile, 'rename', fakeRename)
+            self.assertIs(lockfile.symlink('foo', name), lockfile._Retry)
+            self.assertEqual(os.listdir(os.path.dirname(name)), [])
+
+
+    def test_symlinkRenameErrorWindows(self):
+        """
+        L{lockfile.symlink} passes up any other exception raised by the
+        underlying L{rename} call.
+        """
         name = self.mktemp()
         def fakeRename(src, dst):
-            raise IOError(errno.EIO, None)
+            raise IOError(errno.ENOSYS, None)
         self.patch(lockfile, 'rename', fakeRename)
-        exc = self.assertRaises(IOError, lockfile.symlink, name, "foo")
-        self.assertEqual(exc.errno, errno.EIO)
+        exc = self.assertRaises(IOError, lockfile.symlink, 'foo', name)
+        self.assertEqual(exc.errno, errno.ENOSYS)
     if not platform.isWindows():
-        test_symlinkEIOWindows.skip = (
+        test_symlinkEIOWindows.skip = test_symlinkRenameErrorWindows.skip = (
             "special rename EIO handling only necessary and correct on "
             "Windows.")
 
@@ -72,19 +83,18 @@ class UtilTests(unittest.TestCase):
 
     def test_readlinkEACCESWindows(self):
         """
-        L{lockfile.readlink} raises L{OSError} with C{errno} set to L{EACCES}
-        on Windows when the underlying file open attempt fails with C{EACCES}.
+        L{lockfile.readlink} returns L{lockfile._Retry} on Windows when the
+        underlying file open attempt fails with C{EACCES}.
 
         Opening a file on Windows may fail if the path is inside a directory
         which is in the process of being deleted (directory deletion appears
         not to be atomic).
         """
         name = self.mktemp()
-        def fakeOpen(path, mode):
-            raise IOError(errno.EACCES, None)
-        self.patch(lockfile, '_open', fakeOpen)
-        exc = self.assertRaises(IOError, lockfile.readlink, name)
-        self.assertEqual(exc.errno, errno.EACCES)
+        def fakeOpen(path, flags, mode=0o777):
+            raise OSError(errno.EACCES, None)
+        self.patch(os, 'open', fakeOpen)
+        self.assertIs(lockfile.readlink(name), lockfile._Retry)
     if not platform.isWindows():
         test_readlinkEACCESWindows.skip = (
             "special readlink EACCES handling only necessary and correct on "
@@ -114,7 +124,7 @@ class UtilTests(unittest.TestCase):
     def test_noKillCall(self):
         """
         Verify that when L{lockfile.kill} does end up as None (e.g. on Windows
-        without pywin32), it doesn't end up being called and raising a
+        without ctypes), it doesn't end up being called and raising a
         L{TypeError}.
         """
         self.patch(lockfile, "kill", None)
@@ -123,6 +133,124 @@ class UtilTests(unittest.TestCase):
         self.assertFalse(fl.lock())
 
 
+    def test_backoff(self):
+        """
+        L{lockfile._Backoff.snooze} sleeps for twice as long as it did on the
+        previous call until it reaches L{lockfile._Backoff.maximum}, after
+        which it keeps sleeping for that long.  L{lockfile._Backoff.reset}
+        starts the sequence over.
+        """
+        delays = []
+        self.patch(lockfile, '_sleep', delays.append)
+        backoff = lockfile._Backoff()
+        for i in range(20):
+            backoff.snooze()
+        self.assertEqual(delays[:3], [1e-6, 2e-6, 4e-6])
+        self.assertEqual(delays[-3:], [backoff.maximum] * 3)
+        self.assertEqual(sorted(delays), delays)
+
+        backoff.reset()
+        backoff.snooze()
+        self.assertEqual(delays[-1], 1e-6)
+
+
+    def test_backoffWhenLockVanishes(self):
+        """
+        When the lock disappears between the attempt to create it and the
+        attempt to read it, L{FilesystemLock.lock} backs off before trying
+        again.
+        """
+        delays = []
+        self.patch(lockfile, '_sleep', delays.append)
+
+        def fakeReadlink(name):
+            readlinkPatch.restore()
+            # Pretend to be another process releasing the lock.
+            lockfile.rmlink(lockf)
+            raise OSError(errno.ENOENT, None)
+        readlinkPatch = self.patch(lockfile, 'readlink', fakeReadlink)
+
+        lockf = self.mktemp()
+        lockfile.symlink(str(43125), lockf)
+        lock = lockfile.FilesystemLock(lockf)
+        self.assertTrue(lock.lock())
+        self.assertEqual(delays, [1e-6])
+
+
+    def test_getPIDString(self):
+        """
+        L{lockfile._getPIDString} returns the PID of the current process as a
+        string.
+        """
+        self.assertEqual(lockfile._getPIDString(), str(os.getpid()))
+        self.assertEqual(lockfile._getPIDString(), str(os.getpid()))
+
+
+    def test_unique(self):
+        """
+        L{lockfile.unique} returns a different string each time it is called,
+        prefixed with the PID of the current process.
+        """
+        names = [lockfile.unique() for i in range(100)]
+        self.assertEqual(len(set(names)), len(names))
+        for name in names:
+            self.assertTrue(name.startswith(str(os.getpid()) + "."))
+
+
+    def test_getPIDStringAfterFork(self):
+        """
+        L{lockfile._getPIDString} returns the PID of the child process, not
+        the one cached by its parent, after a fork.
+        """
+        lockfile._getPIDString()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.write(w, lockfile._getPIDString().encode("ascii"))
+            finally:
+                os._exit(0)
+        os.close(w)
+        self.addCleanup(os.close, r)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(r, 32), str(pid).encode("ascii"))
+    if getattr(os, "fork", None) is None:
+        test_getPIDStringAfterFork.skip = "Test requires os.fork."
+
+
+    def test_readlinkBytes(self):
+        """
+        L{lockfile.readlink} returns the target of a symlink as a native
+        string, even if it is given the name of the symlink as L{bytes}.
+        """
+        name = self.mktemp()
+        os.symlink('1234', name)
+        self.assertEqual(lockfile.readlink(name), '1234')
+        self.assertEqual(lockfile.readlink(name.encode('ascii')), '1234')
+    if platform.isWindows():
+        test_readlinkBytes.skip = "Symlinks are not used on Windows."
+
+
+    def test_alive(self):
+        """
+        L{lockfile._alive} returns C{True} for the PID of a process which
+        exists and C{False} for one which does not.
+        """
+        self.assertTrue(lockfile._alive(str(os.getpid())))
+        self.assertFalse(lockfile._alive(str(2 ** 31 - 1)))
+    test_alive.skip = skipKill
+
+
+    def test_aliveEPERM(self):
+        """
+        L{lockfile._alive} returns C{True} for the PID of a process which
+        L{lockfile.kill} isn't allowed to signal.
+        """
+        def fakeKill(pid, signal):
+            raise OSError(errno.EPERM, None)
+        self.patch(lockfile, 'kill', fakeKill)
+        self.assertTrue(lockfile._alive(str(43125)))
+
 
 class LockingTests(unittest.TestCase):
     def _symlinkErrorTest(self, errno):
@@ -159,6 +287,17 @@ class LockingTests(unittest.TestCase):
             "POSIX-specific error propagation not expected on Windows.")
 
 
+    def test_initialState(self):
+        """
+        A new L{FilesystemLock} is not locked and its C{clean} attribute is
+        L{None}.  It has no instance dictionary.
+        """
+        lock = lockfile.FilesystemLock(self.mktemp())
+        self.assertFalse(lock.locked)
+        self.assertIsNone(lock.clean)
+        self.assertFalse(hasattr(lock, '__dict__'))
+
+
     def test_cleanlyAcquire(self):
         """
         If the lock has never been held, it can be acquired and the C{clean}
@@ -261,14 +400,13 @@ class LockingTests(unittest.TestCase):
         If the lock is released while an attempt is made to acquire
         it, the lock attempt fails and C{FilesystemLock.lock} returns
         C{False}.  This can happen on Windows when L{lockfile.symlink}
-        fails with L{IOError} of C{EIO} because another process is in
-        the middle of a call to L{os.rmdir} (implemented in terms of
-        RemoveDirectory) which is not atomic.
+        returns L{lockfile._Retry} because another process is in the
+        middle of deleting the lock, which is not atomic.
         """
         def fakeSymlink(src, dst):
-            # While another process id doing os.rmdir which the Windows
-            # implementation of rmlink does, a rename call will fail with EIO.
-            raise OSError(errno.EIO, None)
+            # While another process is deleting the old lock, symlink will
+            # find that it cannot put its new lock into place.
+            return lockfile._Retry
 
         self.patch(lockfile, 'symlink', fakeSymlink)
 
@@ -276,8 +414,27 @@ class LockingTests(unittest.TestCase):
         lock = lockfile.FilesystemLock(lockf)
         self.assertFalse(lock.lock())
         self.assertFalse(lock.locked)
+
+
+    def test_lockBeingDeletedWindows(self):
+        """
+        If the old lock is in the middle of being deleted, so that renaming
+        the new one into place fails with C{EIO} or C{EACCES},
+        L{FilesystemLock.lock} returns C{False} without leaving anything
+        behind.
+        """
+        for error in (errno.EIO, errno.EACCES):
+            def fakeRename(src, dst):
+                raise OSError(error, None)
+            self.patch(lockfile, 'rename', fakeRename)
+
+            lockf = self.mktemp()
+            lock = lockfile.FilesystemLock(lockf)
+            self.assertFalse(lock.lock())
+            self.assertFalse(lock.locked)
+            self.assertEqual(os.listdir(os.path.dirname(lockf)), [])
     if not platform.isWindows():
-        test_lockReleasedDuringAcquireSymlink.skip = (
+        test_lockBeingDeletedWindows.skip = (
             "special rename EIO handling only necessary and correct on "
             "Windows.")
 
@@ -289,10 +446,10 @@ class LockingTests(unittest.TestCase):
         L{FilesystemLock.lock} returns C{False}.
         """
         def fakeReadlink(name):
-            # While another process is doing os.rmdir which the
-            # Windows implementation of rmlink does, a readlink call
-            # will fail with EACCES.
-            raise IOError(errno.EACCES, None)
+            # While another process is deleting the lock, which the Windows
+            # implementation of rmlink does, readlink will find that it
+            # cannot open it.
+            return lockfile._Retry
         self.patch(lockfile, 'readlink', fakeReadlink)
 
         lockf = self.mktemp()
@@ -300,10 +457,6 @@ class LockingTests(unittest.TestCase):
         lockfile.symlink(str(43125), lockf)
         self.assertFalse(lock.lock())
         self.assertFalse(lock.locked)
-    if not platform.isWindows():
-        test_lockReleasedDuringAcquireReadlink.skip = (
-            "special readlink EACCES handling only necessary and correct on "
-            "Windows.")
 
 
     def _readlinkErrorTest(self, exceptionType, errno):
@@ -405,11 +558,11 @@ class LockingTests(unittest.TestCase):
     def test_killError(self):
         """
         If L{kill} raises an exception other than L{OSError} with errno set to
-        C{ESRCH}, the exception is passed up to the caller of
+        C{ESRCH} or C{EPERM}, the exception is passed up to the caller of
         L{FilesystemLock.lock}.
         """
         def fakeKill(pid, signal):
-            raise OSError(errno.EPERM, None)
+            raise OSError(errno.ENOSYS, None)
         self.patch(lockfile, 'kill', fakeKill)
 
         lockf = self.mktemp()
@@ -419,7 +572,24 @@ class LockingTests(unittest.TestCase):
 
         lock = lockfile.FilesystemLock(lockf)
         exc = self.assertRaises(OSError, lock.lock)
-        self.assertEqual(exc.errno, errno.EPERM)
+        self.assertEqual(exc.errno, errno.ENOSYS)
+        self.assertFalse(lock.locked)
+
+
+    def test_lockedByOtherUser(self):
+        """
+        A lock held by a process which L{kill} isn't allowed to signal, such
+        as one owned by another user, cannot be acquired.
+        """
+        def fakeKill(pid, signal):
+            raise OSError(errno.EPERM, None)
+        self.patch(lockfile, 'kill', fakeKill)
+
+        lockf = self.mktemp()
+        lockfile.symlink(str(43125), lockf)
+
+        lock = lockfile.FilesystemLock(lockf)
+        self.assertFalse(lock.lock())
         self.assertFalse(lock.locked)
 
 
@@ -434,6 +604,36 @@ class LockingTests(unittest.TestCase):
         self.assertRaises(ValueError, lock.unlock)
 
 
+    def test_unlockOtherInstance(self):
+        """
+        L{FilesystemLock.unlock} releases a lock held by this process even if
+        it was acquired through a different L{FilesystemLock} instance.
+        """
+        lockf = self.mktemp()
+        self.assertTrue(lockfile.FilesystemLock(lockf).lock())
+        lock = lockfile.FilesystemLock(lockf)
+        lock.unlock()
+        self.assertFalse(lockfile.isLocked(lockf))
+
+
+    def test_isLockedStale(self):
+        """
+        L{isLocked} returns C{False} if the named lock is held by a process
+        which no longer exists, and leaves the lock in place.
+        """
+        def fakeKill(pid, signal):
+            if signal != 0:
+                raise OSError(errno.EPERM, None)
+            if pid == 43125:
+                raise OSError(errno.ESRCH, None)
+        self.patch(lockfile, 'kill', fakeKill)
+
+        lockf = self.mktemp()
+        lockfile.symlink(str(43125), lockf)
+        self.assertFalse(lockfile.isLocked(lockf))
+        self.assertEqual(lockfile.readlink(lockf), str(43125))
+
+
     def test_isLocked(self):
         """
         L{isLocked} returns C{True} if the named lock is currently locked,